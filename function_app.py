@@ -1,20 +1,114 @@
+import asyncio
 import logging
 import base64
 from io import BytesIO
-from azure.storage.blob import BlobServiceClient
+from azure.storage.blob import StandardBlobTier
+from azure.storage.blob.aio import BlobServiceClient
 from google.oauth2 import service_account
-from googleapiclient.discovery import build
+from google.cloud import vision
+import aiohttp
 import azure.functions as func
 from dotenv import load_dotenv
 import os
-import json
-import requests
-from datetime import datetime
+import orjson
+import time
 from PIL import Image
 
 # Load environment variables
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+# Environment variables (read once per worker process)
+connection_string = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
+google_credentials_file = os.getenv("GOOGLE_CREDENTIALS_FILE")
+google_credentials_b64 = os.getenv("GOOGLE_APPLICATION_CREDENTIALS_B64")
+google_scopes = [os.getenv("GOOGLE_SCOPES")]
+
+# Log environment variable status
+logger.debug("env: conn=%s creds_file=%s creds_b64=%s scopes=%s",
+             bool(connection_string), bool(google_credentials_file),
+             bool(google_credentials_b64), bool(google_scopes[0]))
+
+# Validate environment variables
+if not connection_string:
+    raise ValueError("Missing AZURE_STORAGE_CONNECTION_STRING")
+if not (google_credentials_file or google_credentials_b64):
+    raise ValueError("Missing both GOOGLE_CREDENTIALS_FILE and GOOGLE_APPLICATION_CREDENTIALS_B64")
+if not google_scopes[0]:
+    raise ValueError("Missing GOOGLE_SCOPES")
+
+# Initialize Azure Blob Service Client once per worker process so every
+# invocation reuses the same underlying connection pool
+try:
+    blob_service_client = BlobServiceClient.from_connection_string(connection_string)
+except Exception as e:
+    logger.error("Failed to initialize Azure Blob Service Client: %s", e)
+    raise
+
+# Service-account credentials decoded once per worker; the Credentials
+# object is immutable and refreshes its own access token, so there is no
+# reason to rebuild it per invocation
+_credentials = None
+
+
+def _get_credentials():
+    """Decode and cache the Google service-account credentials."""
+    global _credentials
+    if _credentials is None:
+        try:
+            # Try to get credentials from base64 environment variable first
+            if google_credentials_b64:
+                # orjson.loads accepts bytes directly, so no intermediate
+                # str decode is needed
+                credentials_info = orjson.loads(base64.b64decode(google_credentials_b64))
+                _credentials = service_account.Credentials.from_service_account_info(
+                    credentials_info, scopes=google_scopes
+                )
+            else:
+                # Fall back to file-based credentials (for local development)
+                _credentials = service_account.Credentials.from_service_account_file(
+                    google_credentials_file, scopes=google_scopes
+                )
+        except Exception as e:
+            logger.error("Failed to load Google credentials: %s", e)
+            raise
+    return _credentials
+
+# The gRPC aio channel and the aiohttp session must be created on the
+# running event loop, so both are built lazily on first invocation and
+# then reused across invocations (protobuf over a single HTTP/2 channel,
+# no discovery document and no base64 inflation)
+vision_client = None
+http_session = None
+
+# Reusable output buffer for the JPEG re-encode fallback, allocated once
+# per worker so each invocation does not grow a fresh BytesIO
+_jpeg_buffer = BytesIO()
+
+# Blobs at or under this size in a Vision-native format are sent as-is
+# without even a PIL header parse; larger ones go through PIL so the
+# oversized-image downscale gate can see the pixel dimensions
+_MAX_RAW_BYTES = 3 * 1024 * 1024
+
+
+def _needs_reencode(data: bytes) -> bool:
+    """Return True when the blob must go through the PIL pipeline.
+
+    Sniffs the magic bytes for the formats Vision accepts natively
+    (JPEG, PNG, GIF, WEBP); anything else needs a JPEG re-encode.
+    """
+    head = data[:12]
+    if head[:2] == b'\xff\xd8':  # JPEG
+        return False
+    if head[:8] == b'\x89PNG\r\n\x1a\n':
+        return False
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        return False
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return False
+    return True
+
 app = func.FunctionApp()
 
 @app.function_name(name="ImageProcessingTrigger")
@@ -25,139 +119,108 @@ app = func.FunctionApp()
           max_retry_count=3, 
           minimum_interval="00:00:10", 
           maximum_interval="00:01:00")
-def blob_trigger_function(myblob: func.InputStream):
+async def blob_trigger_function(myblob: func.InputStream):
     """
     Azure Function triggered by blob storage uploads.
     Processes images using Google Vision API and stores results.
     """
+    global vision_client, http_session
     try:
-        logging.info("Starting blob trigger function execution...")
-        
-        # Environment variables
-        connection_string = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
-        google_credentials_file = os.getenv("GOOGLE_CREDENTIALS_FILE")
-        google_credentials_b64 = os.getenv("GOOGLE_APPLICATION_CREDENTIALS_B64")
-        google_scopes = [os.getenv("GOOGLE_SCOPES")]
-
-        # Log environment variable status
-        logging.info(f"Environment variables status:")
-        logging.info(f"AZURE_STORAGE_CONNECTION_STRING exists: {bool(connection_string)}")
-        logging.info(f"GOOGLE_CREDENTIALS_FILE exists: {bool(google_credentials_file)}")
-        logging.info(f"GOOGLE_APPLICATION_CREDENTIALS_B64 exists: {bool(google_credentials_b64)}")
-        logging.info(f"GOOGLE_SCOPES exists: {bool(google_scopes[0])}")
-
-        # Validate environment variables
-        if not connection_string:
-            raise ValueError("Missing AZURE_STORAGE_CONNECTION_STRING")
-        if not (google_credentials_file or google_credentials_b64):
-            raise ValueError("Missing both GOOGLE_CREDENTIALS_FILE and GOOGLE_APPLICATION_CREDENTIALS_B64")
-        if not google_scopes[0]:
-            raise ValueError("Missing GOOGLE_SCOPES")
-
-        logging.info(f"Processing blob:\n"
-                    f"Name: {myblob.name}\n"
-                    f"Size: {myblob.length} bytes\n"
-                    f"URI: {myblob.uri}")
+        logger.info("Starting blob trigger function execution...")
+
+        logger.info("Processing blob:\nName: %s\nSize: %s bytes\nURI: %s",
+                    myblob.name, myblob.length, myblob.uri)
 
         # Validate blob content
         if myblob.length == 0:
             raise ValueError("Empty blob received")
 
-        # Initialize Azure Blob Service Client
-        logging.info("Initializing Azure Blob Service Client...")
-        try:
-            blob_service_client = BlobServiceClient.from_connection_string(connection_string)
-            logging.info("Azure Blob Service Client initialized successfully")
-        except Exception as e:
-            logging.error(f"Failed to initialize Azure Blob Service Client: {str(e)}")
-            raise
-
-        # Initialize Google Vision API
-        logging.info("Initializing Google Vision API...")
-        try:
-            # Try to get credentials from base64 environment variable first
-            credentials_b64 = os.getenv("GOOGLE_APPLICATION_CREDENTIALS_B64")
-            if credentials_b64:
-                # Decode base64 credentials and create service account credentials
-                credentials_json = base64.b64decode(credentials_b64).decode('utf-8')
-                credentials_info = json.loads(credentials_json)
-                credentials = service_account.Credentials.from_service_account_info(
-                    credentials_info, scopes=google_scopes
-                )
-                logging.info("Successfully loaded credentials from base64 environment variable")
-            else:
-                # Fall back to file-based credentials (for local development)
-                credentials = service_account.Credentials.from_service_account_file(
-                    google_credentials_file, scopes=google_scopes
-                )
-                logging.info("Successfully loaded credentials from file")
-            
-            vision_service = build("vision", "v1", credentials=credentials)
-            logging.info("Google Vision API initialized successfully")
-        except Exception as e:
-            logging.error(f"Failed to initialize Google Vision API: {str(e)}")
-            raise
-
         # Process the blob content
-        logging.info("Reading blob content...")
+        logger.info("Reading blob content...")
         image_data = myblob.read()
         
-        # Convert image to JPEG format
-        logging.info("Opening image with PIL...")
-        try:
-            image = Image.open(BytesIO(image_data))
-        except Exception as e:
-            logging.error(f"Failed to open image: {str(e)}")
-            raise
-        
-        # Convert to RGB if needed (in case of RGBA images)
-        if image.mode in ('RGBA', 'LA'):
-            background = Image.new('RGB', image.size, (255, 255, 255))
-            background.paste(image, mask=image.split()[-1])
-            image = background
-        
-        # Save as JPEG in memory
-        buffered = BytesIO()
-        image.save(buffered, format="JPEG", quality=95)
-        
-        # Encode image for Vision API
-        encoded_image = base64.b64encode(buffered.getvalue()).decode('utf-8')
-
-        # Vision API request
-        request_body = {
-            "requests": [{
-                "image": {"content": encoded_image},
-                "features": [
-                    {"type": "TEXT_DETECTION", "maxResults": 50}, 
-                    {"type": "LABEL_DETECTION", "maxResults": 50}
-                ],
-            }]
-        }
+        # Fast path: a Vision-native format small enough that the
+        # downscale gate cannot apply goes out untouched - no PIL at all
+        if not _needs_reencode(image_data) and len(image_data) <= _MAX_RAW_BYTES:
+            vision_image_data = image_data
+        else:
+            # Open with PIL (lazy: only the header is read, no pixel
+            # decode yet)
+            logger.info("Opening image with PIL...")
+            try:
+                image = Image.open(BytesIO(image_data))
+            except Exception as e:
+                logger.error("Failed to open image: %s", e)
+                raise
 
-        # Call Vision API
-        logging.info("Calling Google Vision API...")
-        response = vision_service.images().annotate(body=request_body).execute()
-        
-        if not response.get("responses"):
-            logging.error("Empty response from Vision API")
-            raise ValueError("No response data from Vision API")
-
-        # Parse response
-        logging.info("Parsing Vision API response...")
-        api_response = response.get("responses", [{}])[0]
-        text_annotations = api_response.get("textAnnotations", [])
-        label_annotations = api_response.get("labelAnnotations", [])
+            # Vision accepts JPEG/PNG/GIF/WEBP natively, so only re-encode
+            # when the format is unsupported or the image is so large that
+            # Vision would downscale it anyway
+            needs_downscale = max(image.size) > 2400
+            if (image.format in ('JPEG', 'PNG', 'GIF', 'WEBP')
+                    and not needs_downscale):
+                vision_image_data = image_data
+            else:
+                # Downscale before re-encoding: past ~1600px on the long
+                # edge Vision gains no accuracy, and the smaller raster
+                # cuts both the JPEG encode and the upload. The gate at
+                # 2400px leaves headroom for text-heavy documents where
+                # resolution matters
+                if needs_downscale:
+                    image.thumbnail((1600, 1600), Image.Resampling.LANCZOS)
+
+                # Convert to RGB if needed (in case of RGBA images)
+                if image.mode in ('RGBA', 'LA'):
+                    background = Image.new('RGB', image.size, (255, 255, 255))
+                    background.paste(image, mask=image.split()[-1])
+                    image = background
+                elif image.mode != 'RGB':
+                    image = image.convert('RGB')
+
+                # Save as JPEG into the shared per-worker buffer
+                buffered = _jpeg_buffer
+                buffered.seek(0)
+                buffered.truncate()
+                image.save(buffered, format="JPEG", quality=85)
+                vision_image_data = buffered.getvalue()
+
+        # Call Vision API (raw bytes over gRPC, no base64 step)
+        logger.info("Calling Google Vision API...")
+        if vision_client is None:
+            vision_client = vision.ImageAnnotatorAsyncClient(credentials=_get_credentials())
+        batch_response = await vision_client.batch_annotate_images(requests=[{
+            "image": {"content": vision_image_data},
+            "features": [
+                {"type_": vision.Feature.Type.TEXT_DETECTION, "max_results": 50},
+                {"type_": vision.Feature.Type.LABEL_DETECTION, "max_results": 50},
+            ],
+        }])
+        response = batch_response.responses[0]
+
+        if response.error.message:
+            logger.error("Vision API error: %s", response.error.message)
+            raise ValueError(f"Vision API error: {response.error.message}")
+
+        # Parse response straight off the protobuf message; no dict
+        # materialization step in between
+        logger.info("Parsing Vision API response...")
+        text_annotations = response.text_annotations
+        label_annotations = response.label_annotations
         
-        logging.info(f"Found {len(text_annotations)} text annotations and {len(label_annotations)} labels")
+        logger.info("Found %d text annotations and %d labels", len(text_annotations), len(label_annotations))
 
+        # One gmtime() call covers both the result timestamp and the
+        # archive blob name; the name is built with plain int formatting
+        # instead of the strftime format parser
+        now = time.gmtime()
         parsed_data = {
-            "text_annotations": [{"text": t["description"]} for t in text_annotations],
+            "text_annotations": [{"text": t.description} for t in text_annotations],
             "label_annotations": [
-                {"label": l["description"], "confidence": l["score"]}
+                {"label": l.description, "confidence": l.score}
                 for l in label_annotations
             ],
             "processed_image": myblob.name,
-            "processed_at": datetime.utcnow().isoformat()
+            "processed_at": time.strftime("%Y-%m-%dT%H:%M:%S", now)
         }
 
         # Save latest result to process container
@@ -167,37 +230,50 @@ def blob_trigger_function(myblob: func.InputStream):
             blob=process_blob_name
         )
 
-        # Upload to process container
-        logging.info(f"Uploading results to process container: {process_blob_name}")
-        process_blob_client.upload_blob(json.dumps(parsed_data, indent=2), overwrite=True)
-        logging.info(f"Results saved to process container as '{process_blob_name}'")
-
-        # Save one timestamped copy to process-archive container
-        timestamp = datetime.utcnow().strftime('%Y%m%d%H%M%S')
+        # Timestamped copy goes to the process-archive container
+        timestamp = (f"{now.tm_year:04d}{now.tm_mon:02d}{now.tm_mday:02d}"
+                     f"{now.tm_hour:02d}{now.tm_min:02d}{now.tm_sec:02d}")
         archive_blob_name = f"result_{timestamp}.json"
         archive_blob_client = blob_service_client.get_blob_client(
-            container="process-archive", 
+            container="process-archive",
             blob=archive_blob_name
         )
-        archive_blob_client.upload_blob(json.dumps(parsed_data, indent=2))
+
+        # The latest-result blob stays indented for human readers; the
+        # archive is machine-read cold data, so it drops the ~30% indent
+        # overhead and lands on the cool tier. The two uploads target
+        # different blobs, so let them overlap
+        logger.info("Uploading results to process container: %s", process_blob_name)
+        await asyncio.gather(
+            process_blob_client.upload_blob(
+                orjson.dumps(parsed_data, option=orjson.OPT_INDENT_2), overwrite=True
+            ),
+            archive_blob_client.upload_blob(
+                orjson.dumps(parsed_data),
+                standard_blob_tier=StandardBlobTier.COOL,
+            ),
+        )
+        logger.info("Results saved to process container as '%s'", process_blob_name)
 
         # Trigger AI processing endpoint
         aiopen_url = os.getenv("AIOPEN_PROCESS_URL")
         if aiopen_url:
             try:
-                logging.info(f"Triggering AI processing endpoint: {aiopen_url}")
-                response = requests.post(aiopen_url)
-                response.raise_for_status()
-                logging.info("Successfully triggered AI processing endpoint")
+                logger.info("Triggering AI processing endpoint: %s", aiopen_url)
+                if http_session is None:
+                    http_session = aiohttp.ClientSession()
+                async with http_session.post(aiopen_url) as response:
+                    response.raise_for_status()
+                logger.info("Successfully triggered AI processing endpoint")
             except Exception as e:
-                logging.error(f"Failed to trigger AI processing endpoint: {str(e)}")
+                logger.error("Failed to trigger AI processing endpoint: %s", e)
 
     except ValueError as ve:
-        logging.error(f"Validation error: {str(ve)}", exc_info=True)
+        logger.error("Validation error: %s", ve, exc_info=True)
         raise
     except Exception as e:
-        logging.error(f"Unexpected error: {str(e)}", exc_info=True)
+        logger.error("Unexpected error: %s", e, exc_info=True)
         # Log the full error details
         import traceback
-        logging.error(f"Full traceback:\n{traceback.format_exc()}")
+        logger.error("Full traceback:\n%s", traceback.format_exc())
         raise